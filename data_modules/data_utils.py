@@ -1,33 +1,51 @@
 import os
+import hashlib
 import numpy as np
-from tensorflow.data import Dataset
-from statistics import mean, median, mode
+import tensorflow as tf
+from tensorflow.data import AUTOTUNE, Dataset
 
 
-def __max_policy__(sentences:list) -> int:
-    return max([len(sen.split()) for sen in sentences])
+def __max_policy__(lengths:np.ndarray) -> int:
+    return int(np.max(lengths))
 
-def __mean_policy__(sentences:list) -> int:
-    return int(mean([len(sen.split()) for sen in sentences]))
+def __mean_policy__(lengths:np.ndarray) -> int:
+    return int(np.mean(lengths))
 
-def __mode_policy__(sentences:list) -> int:
-    return int(mode([len(sen.split()) for sen in sentences]))
+def __mode_policy__(lengths:np.ndarray) -> int:
+    return int(np.argmax(np.bincount(lengths)))
 
-def __median_policy__(sentences:list) -> int:
-    return int(median([len(sen.split()) for sen in sentences]))
+def __median_policy__(lengths:np.ndarray) -> int:
+    return int(np.median(lengths))
 
+def __percentile_policy__(lengths:np.ndarray) -> int:
+    return int(np.ceil(np.percentile(lengths, 99)))
 
-def max_sentence_length(sentences:list, policy:str='max') -> int:
-    if policy == 'max':
-        return __max_policy__(sentences)
-    elif policy == 'mode':
-        return __mode_policy__(sentences)
-    elif policy == 'mean':
-        return __mean_policy__(sentences)
-    elif policy == 'median':
-        return __median_policy__(sentences)
+
+__POLICIES__ = {
+    'max': __max_policy__,
+    'mean': __mean_policy__,
+    'mode': __mode_policy__,
+    'median': __median_policy__,
+    'percentile': __percentile_policy__,
+}
+
+
+def max_sentence_length(sentences:list, policy:str='max', tokenizer=None) -> int:
+    '''
+    picks the padding length of the dataset from its sentence lengths\n
+    with a tokenizer, lengths are counted in tokens (special tokens included) from one batched call,
+    otherwise in whitespace separated words\n
+    policy: one of max, mean, median, mode, percentile (99th)\n
+    '''
+    if policy not in __POLICIES__:
+        raise ValueError('the \'policy\' parameter can only take one of these values: {}'.format(', '.join(__POLICIES__)))
+    if tokenizer is not None:
+        lengths = np.asarray(
+            tokenizer(list(sentences), add_special_tokens=True, return_length=True)['length'], dtype=np.int64
+        )
     else:
-        raise 'the \'policy\' parameter can only take one of these values: max, mean, median, mode'
+        lengths = np.fromiter((len(sen.split()) for sen in sentences), dtype=np.int64, count=len(sentences))
+    return __POLICIES__[policy](lengths)
 
 
 #####################################################################################################
@@ -57,13 +75,14 @@ def get_lbl_2_indx(path, intents=None):
     
     return lbl_2_indx
 
-def one_hot_encoder(intents:list, lbl_2_indx:dict) -> np.ndarray:
-    unique = list(set(intents))
-
-    encoded = np.zeros((len(intents), len(lbl_2_indx.keys())))
-    for i, j in enumerate(intents):
-        encoded[i][lbl_2_indx[j]] = 1
-    return encoded
+def one_hot_encoder(intents:list, lbl_2_indx:dict, out:np.ndarray=None) -> np.ndarray:
+    indices = np.fromiter((lbl_2_indx[i] for i in intents), dtype=np.int64, count=len(intents))
+    if out is None:
+        return np.eye(len(lbl_2_indx), dtype=np.float32)[indices]
+    # fill a caller owned (len(intents), num_labels) buffer, e.g. a slice of a larger label matrix
+    out[...] = 0
+    out[np.arange(len(indices)), indices] = 1
+    return out
   
     
 
@@ -85,17 +104,72 @@ def preprocessing(tokenizer, text, max_length, return_tensors='tf', padding='max
   input_ids = tokenized[tokenizer.model_input_names[0]]
   attention_mask = tokenized[tokenizer.model_input_names[2]]
   token_type_ids = tokenized[tokenizer.model_input_names[1]]
-  return input_ids, attention_mask, token_type_ids 
+  return input_ids, attention_mask, token_type_ids
 
-def to_tf_format(x, y=None, buffer_size=None, batch_size=16):
+def cached_preprocessing(tokenizer, text, max_length, cache_dir, split):
+  '''
+  preprocessing whose int32 output is saved under cache_dir and memory mapped on later runs\n
+  Parameters:\n
+  ------------
+  tokenizer: transformers tokenizer object\n
+  text: list of strings\n
+  max_length: int\n
+  cache_dir: str\n
+    e.g. artifacts/<dataset>/tok_cache\n
+  split: str\n
+    name of the split, part of the cache key along with the tokenizer, max_length and the text itself\n
+  Return: numpy.array\n
+    input_ids, attention_mask, token_type_ids\n
+  '''
+  key = hashlib.sha1()
+  for part in (tokenizer.name_or_path, split, str(max_length)):
+    key.update(part.encode('utf-8') + b'\0')
+  key.update('\n'.join(text).encode('utf-8'))
+  path = os.path.join(cache_dir, '{}_{}.npy'.format(split, key.hexdigest()))
+
+  if not os.path.isfile(path):
+    tokenized = preprocessing(tokenizer, text, max_length, return_tensors='np')
+    os.makedirs(cache_dir, exist_ok=True)
+    # one (3, n, max_length) array, so a single memory map serves all three inputs
+    np.save(path, np.stack([tensor.astype(np.int32, copy=False) for tensor in tokenized]))
+  input_ids, attention_mask, token_type_ids = np.load(path, mmap_mode='r')
+  return input_ids, attention_mask, token_type_ids
+
+def preprocessing_splits(tokenizer, splits, max_length, padding='max_length', truncation=True):
+  '''
+  tokenizes several splits with a single tokenizer call and splits the result back\n
+  meant for fast (Rust) tokenizers, which get_bert always returns, that batch the call internally\n
+  Parameters:\n
+  ------------
+  tokenizer: transformers tokenizer object\n
+  splits: list of lists of strings\n
+  max_length: int\n
+    defines maximum padding length\n
+  Return: list of tuples of numpy.array\n
+    (input_ids, attention_mask, token_type_ids) for each split, in the given order\n
   '''
-  converts given data to batched tensorflow dataset\n
+  all_sentences = [sen for split in splits for sen in split]
+  input_ids, attention_mask, token_type_ids = preprocessing(
+    tokenizer, all_sentences, max_length, return_tensors='np', padding=padding, truncation=truncation
+  )
+  offsets = np.cumsum([len(split) for split in splits])[:-1]
+  return list(zip(
+    np.split(input_ids.astype(np.int32, copy=False), offsets),
+    np.split(attention_mask.astype(np.int32, copy=False), offsets),
+    np.split(token_type_ids.astype(np.int32, copy=False), offsets),
+  ))
+
+def to_tf_format(x, y=None, buffer_size=None, batch_size=16, shuffle=True):
+  '''
+  converts given data to batched, cached and prefetched tensorflow dataset\n
   Parameters:\n
   -------------
   x: tuple or iterable objects like list or numpy array\n
   y: iterable objects like list or numpy array\n
   buffer_size: int\n
   batch_size: int\n
+  shuffle: bool\n
+    when False, the original sample order is kept\n
   -------------
   Return: tf.Data.Dataset 
   '''
@@ -106,6 +180,57 @@ def to_tf_format(x, y=None, buffer_size=None, batch_size=16):
     data = x + (y,)
   else:
     data = (x, y)
-  tf_dataset = Dataset.from_tensor_slices(data)
-  tf_dataset = tf_dataset.shuffle(buffer_size=buffer_size).batch(batch_size)
-  return tf_dataset
\ No newline at end of file
+  tf_dataset = Dataset.from_tensor_slices(data).cache()
+  if shuffle:
+    tf_dataset = tf_dataset.shuffle(buffer_size=buffer_size)
+  return tf_dataset.batch(batch_size).prefetch(AUTOTUNE)
+
+def prefetch_to_gpu(tf_dataset, buffer_size=2):
+  '''
+  keeps the next batches in a GPU-resident buffer so steps do not wait on host to device copies\n
+  has to be the last transformation of the dataset; a no-op when no GPU is visible\n
+  Parameters:\n
+  -------------
+  tf_dataset: tf.Data.Dataset\n
+  buffer_size: int\n
+  -------------
+  Return: tf.Data.Dataset
+  '''
+  if not tf.config.list_logical_devices('GPU'):
+    return tf_dataset
+  return tf_dataset.apply(tf.data.experimental.prefetch_to_device('/GPU:0', buffer_size=buffer_size))
+
+def to_tf_format_streaming(tokenizer, text, max_length, buffer_size=None, batch_size=16, shuffle=True):
+  '''
+  converts raw text to a batched tensorflow dataset that tokenizes on the fly\n
+  tokenization runs in parallel map calls, overlapped with the training steps\n
+  Parameters:\n
+  -------------
+  tokenizer: transformers tokenizer object\n
+  text: list of strings\n
+  max_length: int\n
+    defines maximum padding length\n
+  buffer_size: int\n
+  batch_size: int\n
+  shuffle: bool\n
+  -------------
+  Return: tf.Data.Dataset of (input_ids, attention_mask, token_type_ids)
+  '''
+  def __tokenize__(batch):
+    tokenized = preprocessing(
+      tokenizer, [sen.decode('utf-8') for sen in batch.numpy()], max_length, return_tensors='np'
+    )
+    return [tensor.astype(np.int32, copy=False) for tensor in tokenized]
+
+  def __tokenize_batch__(batch):
+    tokenized = tf.py_function(__tokenize__, [batch], [tf.int32] * 3)
+    for tensor in tokenized:
+      tensor.set_shape((None, max_length))
+    return tuple(tokenized)
+
+  tf_dataset = Dataset.from_tensor_slices(text)
+  if shuffle:
+    tf_dataset = tf_dataset.shuffle(buffer_size=buffer_size or len(text))
+  # batching first lets every call hand a whole batch to the fast tokenizer
+  tf_dataset = tf_dataset.batch(batch_size).map(__tokenize_batch__, num_parallel_calls=AUTOTUNE)
+  return tf_dataset.prefetch(AUTOTUNE)
@@ -1,21 +1,36 @@
 import os
 import json
+import hashlib
+import functools
 import pickle
-import random
 import numpy as np
 import tensorflow as tf
 
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
-from data_modules.data_utils import *
+from data_modules.data_utils import (
+    get_lbl_2_indx,
+    max_sentence_length,
+    one_hot_encoder,
+    prefetch_to_gpu,
+    preprocessing_splits,
+    to_tf_format,
+    to_tf_format_streaming,
+)
 from data_modules.dataloader import DataLoader
 
-from model.vae import *
-from model.train import *
-from model.encoder import *
-from model.model_utils import *
+from model.vae import decoder_model, encoder_model, vae, vae_from_embeddings
+from model.train import (
+    cached_embeddings,
+    compute_loss_from_embeddings,
+    compute_loss_stable,
+    train_loop_stable,
+)
+from model.encoder import BalancedDataGenerator, finetune
+from model.model_utils import get_bert, quantize_bert
 
-from utils import *
+from utils import normalize, visualize
 
 import warnings
 
@@ -31,9 +46,15 @@ warnings.filterwarnings("ignore")
 
 
 os.environ["TF_CPP_MIN_LOG_LEVEL"] = "3"
+os.environ["TOKENIZERS_PARALLELISM"] = "true"
 
 
 def run(config):
+    if config.get("use_xla", True):
+        tf.config.optimizer.set_jit(True)
+    precision_policy = config.get("mixed_precision_policy", "float32")
+    tf.keras.mixed_precision.set_global_policy(precision_policy)
+
     path_bert = Path("./artifacts/{}/bert/".format(config["dataset"]))
     path_vae = Path("./artifacts/{}/vae/".format(config["dataset"]))
     path_bert.mkdir(parents=True, exist_ok=True)
@@ -57,7 +78,6 @@ def run(config):
 
     train_intents_encoded = one_hot_encoder(train_intents, in_lbl_2_indx)
     test_intents_encoded = one_hot_encoder(test_intents, in_lbl_2_indx)
-    dev_intents_encoded = one_hot_encoder(dev_intents, in_lbl_2_indx)
 
     ood_lbl_2_indx = get_lbl_2_indx(
         path=os.path.join("dataset", config["dataset"], "ood_lbl_2_indx.txt"),
@@ -68,12 +88,17 @@ def run(config):
 
     print("------------------------------------------------------------------")
 
-    max_length = max_sentence_length(train_sentences, policy=config["seq_length"])
-
     print("Downloading {}".format(config["bert"]))
-    bert, tokenizer = get_bert(config["bert"])
+    hf_cache_dir = os.path.expanduser(
+        config.get("hf_cache_dir", "~/.cache/ensemble_evt/hf")
+    )
+    bert, tokenizer = get_bert(config["bert"], cache_dir=hf_cache_dir)
     print("Download finished successfully!")
 
+    max_length = max_sentence_length(
+        train_sentences, policy=config["seq_length"], tokenizer=tokenizer
+    )
+
     if config.get("use_balanced_sampling", False):
         print("Creating oversampled dataset for consistent BERT and VAE training...")
 
@@ -97,51 +122,66 @@ def run(config):
         train_sentences, train_intents_encoded = (
             balanced_generator.get_oversampled_data()
         )
-        indices = random.sample(
-            range(len(train_sentences)), int(len(train_sentences) / 2)
-        )
-        train_sentences = [train_sentences[i] for i in indices]
-        train_intents_encoded = [train_intents_encoded[i] for i in indices]
+        rng = np.random.default_rng(config.get("random_state", 42))
+        indices = rng.permutation(len(train_sentences))[: len(train_sentences) // 2]
+        train_sentences = np.asarray(train_sentences, dtype=object)[indices].tolist()
+        train_intents_encoded = np.asarray(train_intents_encoded)[indices]
+
+    # finetune trains on train + dev, so dev labels are encoded straight into one shared buffer
+    num_train = len(train_intents_encoded)
+    finetune_intents_encoded = np.empty(
+        (num_train + len(dev_intents), len(in_lbl_2_indx)), dtype=np.float32
+    )
+    finetune_intents_encoded[:num_train] = train_intents_encoded
+    one_hot_encoder(
+        dev_intents, in_lbl_2_indx, out=finetune_intents_encoded[num_train:]
+    )
 
     print("------------------------------------------------------------------")
 
     print("Preparing data for bert, it may take a few minutes...")
-    train_input_ids, train_attention_mask, train_token_type_ids = preprocessing(
-        tokenizer, train_sentences, max_length
-    )
-    test_input_ids, test_attention_mask, test_token_type_ids = preprocessing(
-        tokenizer, test_sentences, max_length
-    )
-    dev_input_ids, dev_attention_mask, dev_token_type_ids = preprocessing(
-        tokenizer, dev_sentences, max_length
-    )
-    ood_input_ids, ood_attention_mask, ood_token_type_ids = preprocessing(
-        tokenizer, ood_sentences, max_length
-    )
+    stream_tokenization = config.get("stream_tokenization", False)
+    splits = [test_sentences, dev_sentences, ood_sentences]
+    if not stream_tokenization:
+        splits = [train_sentences] + splits
+    tokenized = preprocessing_splits(tokenizer, splits, max_length)
+    (
+        (test_input_ids, test_attention_mask, test_token_type_ids),
+        (dev_input_ids, dev_attention_mask, dev_token_type_ids),
+        (ood_input_ids, ood_attention_mask, ood_token_type_ids),
+    ) = tokenized[-3:]
 
-    train_tf = to_tf_format(
-        (train_input_ids, train_attention_mask, train_token_type_ids),
-        None,
-        len(train_sentences),
-        batch_size=16,
-    )
+    if stream_tokenization:
+        # Tokenize the training set inside the input pipeline, overlapped with training
+        train_tf = to_tf_format_streaming(
+            tokenizer, train_sentences, max_length, batch_size=16
+        )
+    else:
+        train_tf = to_tf_format(
+            tokenized[0],
+            None,
+            len(train_sentences),
+            batch_size=16,
+        )
+    # Evaluation keeps per-sample losses, so only the batch size changes here
+    eval_batch_size = config.get("eval_batch_size", max(32, config["batch_size"]))
     test_tf = to_tf_format(
         (test_input_ids, test_attention_mask, test_token_type_ids),
         None,
         len(test_sentences),
-        batch_size=1,
+        batch_size=eval_batch_size,
     )
     dev_tf = to_tf_format(
         (dev_input_ids, dev_attention_mask, dev_token_type_ids),
         None,
         len(dev_sentences),
-        batch_size=1,
+        batch_size=eval_batch_size,
     )
     ood_tf = to_tf_format(
         (ood_input_ids, ood_attention_mask, ood_token_type_ids),
         None,
         len(ood_sentences),
-        batch_size=1,
+        batch_size=eval_batch_size,
     )
     print("Data preparation finished successfully!")
 
@@ -156,11 +196,11 @@ def run(config):
     # )
     classifier = finetune(
         x_train=train_sentences + dev_sentences,
-        y_train=np.concatenate((train_intents_encoded, dev_intents_encoded), axis=0),
+        y_train=finetune_intents_encoded,
         x_validation=test_sentences,
         y_validation=test_intents_encoded,
         max_length=max_length,
-        num_labels=len(np.unique(np.array(train_intents))),
+        num_labels=len(in_lbl_2_indx),
         path=os.path.join("artifacts", config["dataset"], "bert/"),
         train=config["finetune"],
         first_layers_to_freeze=10,
@@ -183,11 +223,9 @@ def run(config):
         lr_decay_steps=config.get("lr_decay_steps", None),
         lr_decay_rate=config.get("lr_decay_rate", 0.96),
         random_state=config.get("random_state", 42),
+        bert=bert,
+        cache_dir=hf_cache_dir,
     )
-    classifier.load_weights(
-        os.path.join("artifacts", config["dataset"], "bert/best_model")
-    )
-    bert.layers[0].set_weights(classifier.layers[0].get_weights())
     print(
         "Finetuning finished successfully and weights saved to {}".format(
             os.path.join("artifacts", config["dataset"], "bert/")
@@ -204,19 +242,21 @@ def run(config):
     #     input_shape=((max_length,))
     # )
 
+    encoder = encoder_model(
+        (config["vector_dim"],),
+        config["latent_dim"],
+        dims=config["encoder"],
+        activation=config.get("activation", "relu"),  # Use relu instead of tanh
+    )
+    decoder = decoder_model(
+        (config["latent_dim"],),
+        dims=config["decoder"],
+        activation=config.get("activation", "relu"),
+    )
     model = vae(
         bert=bert,
-        encoder=encoder_model(
-            (config["vector_dim"],),
-            config["latent_dim"],
-            dims=config["encoder"],
-            activation=config.get("activation", "relu"),  # Use relu instead of tanh
-        ),
-        decoder=decoder_model(
-            (config["latent_dim"],),
-            dims=config["decoder"],
-            activation=config.get("activation", "relu"),
-        ),
+        encoder=encoder,
+        decoder=decoder,
         input_shape=((max_length,)),
         beta=config.get("vae_beta", 1.0),  # Beta-VAE parameter
     )
@@ -239,12 +279,89 @@ def run(config):
         # Use constant learning rate
         optimizer = tf.keras.optimizers.Adam(learning_rate=initial_lr)
 
+    if precision_policy == "mixed_float16":
+        # float16 gradients need loss scaling to avoid underflow
+        optimizer = tf.keras.mixed_precision.LossScaleOptimizer(optimizer)
+
     train_loss_metric = tf.keras.metrics.Mean()
     val_loss_metric = tf.keras.metrics.Mean()
     print("Model is created successfully!")
 
     print("------------------------------------------------------------------")
 
+    print("Caching BERT embeddings for VAE training...")
+    # BERT is frozen, so run it once and train only the VAE head on its outputs
+    reuse_embeddings = not config["finetune"]
+    embedding_bert = bert
+    if config.get("quantize_bert", False):
+        # Frozen feature extractor, so post-training int8 weights are enough. Converted
+        # once, on first use, so reused embeddings skip the conversion
+        embedding_bert = functools.lru_cache(maxsize=None)(
+            functools.partial(quantize_bert, bert, max_length)
+        )
+    # Everything that changes the features, saved embeddings are only reused on a match
+    best_model_index = os.path.join(
+        "artifacts", config["dataset"], "bert", "best_model.index"
+    )
+    embedding_metadata = {
+        "bert": config["bert"],
+        "checkpoint_mtime": (
+            os.path.getmtime(best_model_index)
+            if os.path.isfile(best_model_index)
+            else None
+        ),
+        "max_length": int(max_length),
+        "mixed_precision_policy": precision_policy,
+        "quantize_bert": bool(config.get("quantize_bert", False)),
+    }
+    train_embeddings = cached_embeddings(
+        embedding_bert,
+        train_tf.unbatch().batch(64),
+        os.path.join("artifacts", config["dataset"], "vae", "train_embeddings.npy"),
+        len(train_sentences),
+        reuse=reuse_embeddings,
+        metadata=dict(
+            embedding_metadata,
+            sentences=hashlib.sha1(
+                "\n".join(train_sentences).encode("utf-8")
+            ).hexdigest(),
+        ),
+    )
+    dev_embeddings = cached_embeddings(
+        embedding_bert,
+        dev_tf,
+        os.path.join("artifacts", config["dataset"], "vae", "dev_embeddings.npy"),
+        len(dev_sentences),
+        reuse=reuse_embeddings,
+        metadata=dict(
+            embedding_metadata,
+            sentences=hashlib.sha1(
+                "\n".join(dev_sentences).encode("utf-8")
+            ).hexdigest(),
+        ),
+    )
+    train_embeddings_tf = prefetch_to_gpu(
+        to_tf_format(
+            train_embeddings,
+            None,
+            len(train_embeddings),
+            batch_size=config["batch_size"],
+        )
+    )
+    dev_embeddings_tf = prefetch_to_gpu(
+        to_tf_format(
+            dev_embeddings, None, len(dev_embeddings), batch_size=64, shuffle=False
+        )
+    )
+    head = vae_from_embeddings(
+        encoder,
+        decoder,
+        (config["vector_dim"],),
+        beta=config.get("vae_beta", 1.0),
+    )
+
+    print("------------------------------------------------------------------")
+
     print("Training of VAE is in progress...")
     # train_loop(
     #     model,
@@ -257,11 +374,11 @@ def run(config):
     #     train_loss_metric=train_loss_metric, val_loss_metric=val_loss_metric
     # )
     history = train_loop_stable(
-        model,
+        head,
         optimizer,
-        train_tf,
-        dev_tf,
-        path=os.path.join("artifacts", config["dataset"], "vae", "vae.h5"),
+        train_embeddings_tf,
+        dev_embeddings_tf,
+        path=os.path.join("artifacts", config["dataset"], "vae", "vae_head_ckpt"),
         batch_size=config["batch_size"],
         num_epochs=config["train_epochs"],
         train_loss_metric=train_loss_metric,
@@ -270,21 +387,30 @@ def run(config):
         clip_norm=config.get("vae_clip_norm", 1.0),
         lr_reduce_patience=config.get("vae_lr_reduce_patience", 5),
     )
-    model.load_weights(os.path.join("artifacts", config["dataset"], "vae", "vae.h5"))
+    head.load_weights(
+        os.path.join("artifacts", config["dataset"], "vae", "vae_head_ckpt")
+    ).expect_partial()
+    # Encoder/decoder only, BERT stays with the fine-tuned classifier checkpoint
+    head.save_weights(
+        os.path.join("artifacts", config["dataset"], "vae", "vae_ckpt"),
+        overwrite=True,
+        save_format="tf",
+    )
     with open(
         os.path.join("artifacts", config["dataset"], "vae", "training_history.pkl"),
         "wb",
     ) as f:
-        pickle.dump(history, f)
+        history = {k: np.asarray(v, dtype=np.float32) for k, v in history.items()}
+        pickle.dump(history, f, protocol=pickle.HIGHEST_PROTOCOL)
     print(
         "Training is done and weights saved to {}".format(
-            os.path.join("artifacts", config["dataset"], "vae", "vae.h5")
+            os.path.join("artifacts", config["dataset"], "vae", "vae_ckpt")
         )
     )
 
     print("Verifying model outputs...")
     sample_batch = next(iter(dev_tf))
-    sample_output = model(sample_batch, training=False)
+    sample_output, _ = model(sample_batch, training=False)
     print(f"Sample output shape: {sample_output.shape}")
     print(
         f"Sample output range: [{tf.reduce_min(sample_output):.3f}, {tf.reduce_max(sample_output):.3f}]"
@@ -298,36 +424,46 @@ def run(config):
     print("------------------------------------------------------------------")
 
     print("Calculating train and dev loss for visualization...")
-    train_tf = to_tf_format(
-        (train_input_ids, train_attention_mask, train_token_type_ids),
-        None,
-        len(train_sentences),
-        batch_size=1,
-    )
-    train_loss = compute_loss_stable(model, train_tf)
-    dev_loss = compute_loss_stable(model, dev_tf)
+    if config.get("loss_from_embeddings", True) or config.get("quantize_bert", False):
+        # Reuse the cached embeddings and evaluate only the VAE head, the float BERT
+        # would give different features than a head trained on quantized ones
+        train_loss, dev_loss = compute_loss_from_embeddings(
+            head, [train_embeddings, dev_embeddings]
+        )
+    else:
+        # Full BERT + VAE pass, kept for validating the embedding path
+        train_tf = train_tf.unbatch().batch(128).prefetch(tf.data.AUTOTUNE)
+        train_loss = compute_loss_stable(model, train_tf)
+        dev_loss = compute_loss_stable(model, dev_tf)
     train_loss_normalized = normalize(
         train_loss, path=os.path.join("artifacts", config["dataset"]), mode="train"
     )
     dev_loss_normalized = normalize(
         dev_loss, path=os.path.join("artifacts", config["dataset"]), mode="eval"
     )
-    visualize(
-        train_loss_normalized,
-        os.path.join(
-            "artifacts",
-            config["dataset"],
-            "vae_loss_for_{}_train.png".format(config["dataset"]),
-        ),
-    )
-    visualize(
-        dev_loss_normalized,
-        os.path.join(
-            "artifacts",
-            config["dataset"],
-            "vae_loss_for_{}_dev.png".format(config["dataset"]),
-        ),
-    )
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        figures = [
+            executor.submit(
+                visualize,
+                train_loss_normalized,
+                os.path.join(
+                    "artifacts",
+                    config["dataset"],
+                    "vae_loss_for_{}_train.png".format(config["dataset"]),
+                ),
+            ),
+            executor.submit(
+                visualize,
+                dev_loss_normalized,
+                os.path.join(
+                    "artifacts",
+                    config["dataset"],
+                    "vae_loss_for_{}_dev.png".format(config["dataset"]),
+                ),
+            ),
+        ]
+        for figure in figures:
+            figure.result()
     print(
         "You can use figures in {} to decide what threshold should be used.".format(
             os.path.join("artifacts", config["dataset"])
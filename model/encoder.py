@@ -5,10 +5,13 @@ from model.metrics import f1_m
 from tensorflow.keras.utils import Sequence
 from sklearn.utils.class_weight import compute_class_weight
 from transformers import TFAutoModelForSequenceClassification, AutoTokenizer
+from model.model_utils import from_pretrained_local_first
 
 
-def __finetune_preprocess__(x, y, model_name, batch_size, max_length):
-    tokenizer = AutoTokenizer.from_pretrained(model_name)
+def __finetune_preprocess__(x, y, model_name, batch_size, max_length, cache_dir=None):
+    tokenizer = from_pretrained_local_first(
+        AutoTokenizer.from_pretrained, model_name, cache_dir
+    )
     x_tokenized = tokenizer(
         x,
         return_tensors="tf",
@@ -211,6 +214,10 @@ class FocalLoss(tf.keras.losses.Loss):
         self.from_logits = from_logits
 
     def call(self, y_true, y_pred):
+        # Compute the loss in float32 even when the model runs in mixed precision
+        y_pred = tf.cast(y_pred, tf.float32)
+        y_true = tf.cast(y_true, tf.float32)
+
         # Convert to probabilities if logits
         if self.from_logits:
             y_pred = tf.nn.softmax(y_pred, axis=-1)
@@ -383,6 +390,8 @@ def finetune(
     lr_decay_steps=None,
     lr_decay_rate=0.96,
     random_state=42,
+    bert=None,
+    cache_dir=None,
 ):
     """
     Enhanced finetune function with support for imbalanced datasets
@@ -418,12 +427,18 @@ def finetune(
     lr_decay_steps: Steps for learning rate decay
     lr_decay_rate: Decay rate for learning rate
     random_state: Random seed
+    bert: Optional TFBertModel whose encoder the returned classifier shares,
+        so it holds the best finetuned weights once this returns
+    cache_dir: Hugging Face cache directory, read before contacting the hub
     """
 
     if train:
         # Create classifier model
-        classifier = TFAutoModelForSequenceClassification.from_pretrained(
-            model_name, num_labels=num_labels
+        classifier = from_pretrained_local_first(
+            TFAutoModelForSequenceClassification.from_pretrained,
+            model_name,
+            cache_dir,
+            num_labels=num_labels,
         )
 
         # Freeze specified layers
@@ -511,7 +526,9 @@ def finetune(
             train_generator = BalancedDataGenerator(
                 x=x_train,
                 y=y_train,
-                tokenizer=AutoTokenizer.from_pretrained(model_name),
+                tokenizer=from_pretrained_local_first(
+                    AutoTokenizer.from_pretrained, model_name, cache_dir
+                ),
                 max_length=max_length,
                 batch_size=batch_size,
                 model_name=model_name,
@@ -521,7 +538,7 @@ def finetune(
 
             # Validation data (normal preprocessing)
             dev_data = __finetune_preprocess__(
-                x_validation, y_validation, model_name, 1, max_length
+                x_validation, y_validation, model_name, 1, max_length, cache_dir
             )
 
             # Train with generator
@@ -535,10 +552,10 @@ def finetune(
         else:
             # Use normal data preprocessing
             train_data = __finetune_preprocess__(
-                x_train, y_train, model_name, batch_size, max_length
+                x_train, y_train, model_name, batch_size, max_length, cache_dir
             )
             dev_data = __finetune_preprocess__(
-                x_validation, y_validation, model_name, 1, max_length
+                x_validation, y_validation, model_name, 1, max_length, cache_dir
             )
 
             # Train with class weights if specified
@@ -554,9 +571,15 @@ def finetune(
         del classifier
 
     # Load the best model
-    classifier = TFAutoModelForSequenceClassification.from_pretrained(
-        model_name, num_labels=num_labels
+    classifier = from_pretrained_local_first(
+        TFAutoModelForSequenceClassification.from_pretrained,
+        model_name,
+        cache_dir,
+        num_labels=num_labels,
     )
+    if bert is not None:
+        # Swap in the caller's encoder so the checkpoint restores straight into it
+        classifier.bert = bert.bert
     classifier.load_weights(os.path.join(path, "best_model"))
 
     return classifier
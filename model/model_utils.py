@@ -1,7 +1,109 @@
+import functools
+import numpy as np
+import tensorflow as tf
 from transformers import AutoTokenizer, TFBertModel
 
 
-def get_bert(name:str='bert-base-uncased'):
-  bert = TFBertModel.from_pretrained(name)
-  tokenizer = AutoTokenizer.from_pretrained(name)
+def from_pretrained_local_first(loader, name:str, cache_dir:str=None, **kwargs):
+  '''
+  calls a transformers from_pretrained on cache_dir without contacting the hub, downloading only when nothing is cached yet\n
+  Parameters:\n
+  ------------
+  loader: from_pretrained of a transformers model or tokenizer class\n
+  name: str\n
+  cache_dir: str\n
+  kwargs: passed on to the loader\n
+  '''
+  try:
+    return loader(name, cache_dir=cache_dir, local_files_only=True, **kwargs)
+  except OSError:
+    # Not cached yet, fetch it from the hub once
+    return loader(name, cache_dir=cache_dir, **kwargs)
+
+
+@functools.lru_cache(maxsize=2)
+def __load_bert__(name, cache_dir):
+  bert = from_pretrained_local_first(TFBertModel.from_pretrained, name, cache_dir)
+  tokenizer = from_pretrained_local_first(AutoTokenizer.from_pretrained, name, cache_dir, use_fast=True)
   return bert, tokenizer
+
+
+def get_bert(name:str='bert-base-uncased', cache_dir:str=None):
+  '''
+  loads a pretrained bert and its fast tokenizer, reading the checkpoint only once per process\n
+  the local cache is tried first, the hub only when the checkpoint is not cached yet\n
+  every call returns a fresh copy of the cached weights, so fine-tuning one run never leaks into the next\n
+  Return: (transformers.TFBertModel, tokenizer)
+  '''
+  cached_bert, tokenizer = __load_bert__(name, cache_dir)
+  # clone_model does not support subclassed transformers models, so rebuild from the config
+  bert = TFBertModel(cached_bert.config)
+  bert(bert.dummy_inputs, training=False)
+  bert.set_weights(cached_bert.get_weights())
+  return bert, tokenizer
+
+
+def quantize_bert(bert, max_length:int):
+  '''
+  converts a frozen bert to a TFLite interpreter with int8 weights returning CLS embeddings\n
+  a float32 copy is traced, TFLite kernels do not take the float16 activations of mixed precision\n
+  Parameters:\n
+  ------------
+  bert: transformers TFBertModel\n
+  max_length: int\n
+    padded sequence length of the inputs\n
+  Return: tf.lite.Interpreter
+  '''
+  policy = tf.keras.mixed_precision.global_policy()
+  tf.keras.mixed_precision.set_global_policy('float32')
+  try:
+    float_bert = TFBertModel(bert.config)
+    float_bert(float_bert.dummy_inputs, training=False)
+  finally:
+    tf.keras.mixed_precision.set_global_policy(policy)
+  float_bert.set_weights(bert.get_weights())
+
+  input_signature = [
+    tf.TensorSpec((None, max_length), tf.int32, name=name)
+    for name in ('input_ids', 'attention_mask', 'token_type_ids')
+  ]
+
+  @tf.function(input_signature=input_signature)
+  def cls_embeddings(input_ids, attention_mask, token_type_ids):
+    output = float_bert(input_ids, attention_mask=attention_mask, token_type_ids=token_type_ids, training=False)
+    return output[0][:, 0]
+
+  converter = tf.lite.TFLiteConverter.from_concrete_functions(
+    [cls_embeddings.get_concrete_function()], float_bert
+  )
+  converter.optimizations = [tf.lite.Optimize.DEFAULT]
+  return tf.lite.Interpreter(model_content=converter.convert())
+
+
+def quantized_embeddings(interpreter, data):
+  '''
+  runs a quantized bert from quantize_bert over batches of (input_ids, attention_mask, token_type_ids)\n
+  Return: numpy.array of CLS embeddings
+  '''
+  names = ('input_ids', 'attention_mask', 'token_type_ids')
+  input_details = interpreter.get_input_details()
+  input_indices = [
+    next(detail['index'] for detail in input_details if name in detail['name'])
+    for name in names
+  ]
+  output_index = interpreter.get_output_details()[0]['index']
+
+  embeddings = []
+  allocated_shape = None
+  for batch in data:
+    batch = [np.asarray(tensor, dtype=np.int32) for tensor in batch]
+    if batch[0].shape != allocated_shape:
+      for index in input_indices:
+        interpreter.resize_tensor_input(index, batch[0].shape)
+      interpreter.allocate_tensors()
+      allocated_shape = batch[0].shape
+    for index, tensor in zip(input_indices, batch):
+      interpreter.set_tensor(index, tensor)
+    interpreter.invoke()
+    embeddings.append(interpreter.get_tensor(output_index))
+  return np.concatenate(embeddings, axis=0)
@@ -1,16 +1,26 @@
+import os
+import json
 import time
 import numpy as np
 import tensorflow as tf
+from model.model_utils import quantized_embeddings
 
 
-@tf.function
-def train_step(model, optimizer, x, y, z, clip_norm=1.0):
-    """Training step with gradient clipping"""
+@tf.function(jit_compile=True)
+def compute_gradients(model, optimizer, inputs, clip_norm=1.0):
+    """Forward and backward pass with gradient clipping, fused by XLA"""
+    loss_scaling = isinstance(optimizer, tf.keras.mixed_precision.LossScaleOptimizer)
     with tf.GradientTape() as tape:
-        logits = model([x, y, z], training=True)
+        logits = model(inputs, training=True)
         loss_value = model.losses
+        if loss_scaling:
+            scaled_loss = optimizer.get_scaled_loss(tf.add_n(loss_value))
 
-    grads = tape.gradient(loss_value, model.trainable_weights)
+    if loss_scaling:
+        grads = tape.gradient(scaled_loss, model.trainable_weights)
+        grads = optimizer.get_unscaled_gradients(grads)
+    else:
+        grads = tape.gradient(loss_value, model.trainable_weights)
 
     # Gradient clipping to prevent exploding gradients
     grads, _ = tf.clip_by_global_norm(grads, clip_norm)
@@ -20,24 +30,55 @@ def train_step(model, optimizer, x, y, z, clip_norm=1.0):
         [tf.reduce_any(tf.math.is_nan(g)) for g in grads if g is not None]
     )
 
-    # Only apply gradients if they're valid
-    tf.cond(
-        has_nan,
-        lambda: tf.print("Warning: NaN gradients detected, skipping update"),
-        lambda: optimizer.apply_gradients(zip(grads, model.trainable_weights)),
+    return loss_value, grads, has_nan
+
+
+@tf.function
+def train_step(model, optimizer, inputs, clip_norm=1.0):
+    """Training step with gradient clipping"""
+    # tf.print has no XLA kernel, so only the gradient computation is compiled
+    loss_value, grads, has_nan = compute_gradients(
+        model, optimizer, inputs, clip_norm
     )
 
+    if isinstance(optimizer, tf.keras.mixed_precision.LossScaleOptimizer):
+        # The loss scale optimizer skips non-finite updates and lowers its scale itself
+        optimizer.apply_gradients(zip(grads, model.trainable_weights))
+    else:
+        # Only apply gradients if they're valid
+        tf.cond(
+            has_nan,
+            lambda: tf.print("Warning: NaN gradients detected, skipping update"),
+            lambda: optimizer.apply_gradients(zip(grads, model.trainable_weights)),
+        )
+
     return loss_value, has_nan
 
 
-@tf.function
-def test_step(model, x, y, z):
+@tf.function(jit_compile=True)
+def test_step(model, inputs):
     """Validation step"""
-    logits = model([x, y, z], training=False)
+    logits = model(inputs, training=False)
     loss_value = model.losses
     return loss_value
 
 
+@tf.function(jit_compile=True)
+def loss_step(model, inputs):
+    """Per-sample losses of a batch, the second output of vae and vae_from_embeddings"""
+    _, losses = model(inputs, training=False)
+    return losses
+
+
+@tf.function
+def embedding_step(bert, x, y, z):
+    """CLS embeddings of a batch"""
+    return tf.cast(
+        bert(x, token_type_ids=z, attention_mask=y, training=False)[0][:, 0],
+        tf.float32,
+    )
+
+
 def get_current_learning_rate(optimizer):
     """Get current learning rate, handling both constant and schedule cases"""
     if hasattr(optimizer.learning_rate, "numpy"):
@@ -90,8 +131,8 @@ def train_loop_stable(
         nan_count = 0
 
         # Training
-        for step, (x, y, z) in enumerate(train_data):
-            loss_value, has_nan = train_step(model, optimizer, x, y, z, clip_norm)
+        for step, inputs in enumerate(train_data):
+            loss_value, has_nan = train_step(model, optimizer, inputs, clip_norm)
 
             if has_nan:
                 nan_count += 1
@@ -121,8 +162,8 @@ def train_loop_stable(
         train_loss_metric.reset_states()
 
         # Validation
-        for x, y, z in val_data:
-            val_loss_metric.update_state(test_step(model, x, y, z))
+        for inputs in val_data:
+            val_loss_metric.update_state(test_step(model, inputs))
 
         val_loss = float(val_loss_metric.result().numpy())
 
@@ -140,7 +181,7 @@ def train_loop_stable(
                 f"Validation loss improved from {best_val_loss:.4f} to {val_loss:.4f}"
             )
             best_val_loss = val_loss
-            model.save_weights(filepath=path, overwrite=True, save_format="h5")
+            model.save_weights(filepath=path, overwrite=True, save_format="tf")
             patience_counter = 0
             lr_reduce_counter = 0
         else:
@@ -176,18 +217,81 @@ def train_loop_stable(
     return history
 
 
-def compute_loss_stable(model, data):
-    """Compute loss with NaN checking"""
-    losses = []
-    for step, (x, y, z) in enumerate(data):
-        loss = test_step(model, x, y, z)[0].numpy()
-        if np.isnan(loss) or np.isinf(loss):
-            print(f"Warning: NaN/Inf loss detected at step {step}, skipping")
-            continue
-        losses.append(loss)
-
-    if len(losses) == 0:
+def compute_per_example_losses(model, data):
+    """Compute per-sample losses over batches of any size, NaN/Inf included"""
+    return np.concatenate(
+        [loss_step(model, inputs).numpy() for inputs in data], axis=0
+    )
+
+
+def drop_invalid_losses(losses):
+    """Remove NaN/Inf losses"""
+    finite = np.isfinite(losses)
+    if not np.any(finite):
         print("ERROR: All losses were NaN/Inf")
         return np.array([np.inf])
 
-    return np.array(losses)
+    if not np.all(finite):
+        print(f"Warning: {np.sum(~finite)} NaN/Inf losses detected, skipping")
+
+    return losses[finite]
+
+
+def compute_loss_stable(model, data):
+    """Compute loss with NaN checking"""
+    return drop_invalid_losses(compute_per_example_losses(model, data))
+
+
+def compute_embeddings(bert, data):
+    """Run BERT (or its quantized interpreter) once over the data and collect the CLS embeddings"""
+    if isinstance(bert, tf.lite.Interpreter):
+        return quantized_embeddings(bert, data)
+    return np.concatenate(
+        [embedding_step(bert, x, y, z).numpy() for x, y, z in data], axis=0
+    )
+
+
+def cached_embeddings(bert, data, path, num_samples, reuse=True, metadata=None):
+    """
+    Load CLS embeddings saved by a previous run, or compute and save them
+
+    bert is a model, a quantized interpreter, or a function building one, which
+    is only called when the embeddings have to be computed.
+
+    metadata describes what produced the embeddings (checkpoint, max_length,
+    precision, ...). It is stored next to the array and a saved file is only
+    reused when it matches exactly.
+    """
+    metadata_path = os.path.splitext(path)[0] + ".json"
+    metadata = dict(metadata or {}, num_samples=int(num_samples))
+    if reuse and os.path.isfile(path) and os.path.isfile(metadata_path):
+        with open(metadata_path, "r") as f:
+            saved_metadata = json.load(f)
+        if saved_metadata == metadata:
+            embeddings = np.load(path, mmap_mode="r")
+            if embeddings.shape[0] == num_samples:
+                return embeddings
+
+    if not isinstance(bert, (tf.keras.Model, tf.lite.Interpreter)):
+        bert = bert()
+    embeddings = compute_embeddings(bert, data)
+    np.save(path, embeddings)
+    with open(metadata_path, "w") as f:
+        json.dump(metadata, f, sort_keys=True)
+    return embeddings
+
+
+def compute_loss_from_embeddings(model, embeddings, batch_size=128):
+    """
+    Compute losses of a VAE head for several embedding sets in a single pass
+
+    Returns one NaN-checked loss array per embedding set, in the given order
+    """
+    offsets = np.cumsum([len(e) for e in embeddings])[:-1]
+    data = (
+        tf.data.Dataset.from_tensor_slices(np.concatenate(embeddings, axis=0))
+        .batch(batch_size)
+        .prefetch(tf.data.AUTOTUNE)
+    )
+    losses = compute_per_example_losses(model, data)
+    return [drop_invalid_losses(split) for split in np.split(losses, offsets)]
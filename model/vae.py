@@ -2,7 +2,9 @@ import tensorflow as tf
 from tensorflow_probability import distributions as tfd
 
 
-def vae_cost(y_true, y_pred, mu, log_var, z_sample, analytic_kl=True, kl_weight=1.0):
+def vae_cost(
+    y_true, y_pred, mu, log_var, z_sample, analytic_kl=True, kl_weight=1.0, reduce=True
+):
     """
     Compute VAE loss with numerical stability improvements
 
@@ -14,6 +16,7 @@ def vae_cost(y_true, y_pred, mu, log_var, z_sample, analytic_kl=True, kl_weight=
         z_sample: Sampled latent representation
         analytic_kl: Whether to use analytical KL divergence
         kl_weight: Weight for KL divergence term
+        reduce: Whether to average over the batch or return per-sample losses
     """
     # Reconstruction loss using MSE for continuous embeddings
     reconstruction_loss = tf.reduce_mean(tf.square(y_true - y_pred), axis=1)
@@ -30,6 +33,7 @@ def vae_cost(y_true, y_pred, mu, log_var, z_sample, analytic_kl=True, kl_weight=
         kl_divergence = tf.maximum(kl_divergence, 1e-6)
     else:
         # Monte Carlo approximation
+        z_sample = tf.cast(z_sample, mu.dtype)
         log_pz = -0.5 * tf.reduce_sum(tf.square(z_sample), axis=1)
         log_qz_x = -0.5 * tf.reduce_sum(
             log_var + tf.square(z_sample - mu) / tf.exp(log_var), axis=1
@@ -38,9 +42,9 @@ def vae_cost(y_true, y_pred, mu, log_var, z_sample, analytic_kl=True, kl_weight=
 
     # Compute ELBO (Evidence Lower Bound)
     # ELBO = -E[log p(x|z)] + KL(q(z|x)||p(z))
-    elbo = tf.reduce_mean(reconstruction_loss + kl_weight * kl_divergence)
+    elbo = reconstruction_loss + kl_weight * kl_divergence
 
-    return elbo
+    return tf.reduce_mean(elbo) if reduce else elbo
 
 
 class Sampling(tf.keras.layers.Layer):
@@ -50,7 +54,7 @@ class Sampling(tf.keras.layers.Layer):
         mu, log_var = inputs
         batch = tf.shape(mu)[0]
         dim = tf.shape(mu)[1]
-        epsilon = tf.random.normal(shape=(batch, dim))
+        epsilon = tf.random.normal(shape=(batch, dim), dtype=mu.dtype)
 
         # Sample: z = mu + sigma * epsilon, where sigma = exp(0.5 * log_var)
         return mu + tf.exp(0.5 * log_var) * epsilon
@@ -65,9 +69,9 @@ def encoder_layers(inputs, latent_dim, dims: list, activation: str):
         encoder = tf.keras.layers.Dense(units=dim, activation=activation)(encoder)
         encoder = tf.keras.layers.Dropout(0.2)(encoder)
 
-    # Output layers - no activation for mu and log_var
-    mu = tf.keras.layers.Dense(units=latent_dim)(encoder)
-    log_var = tf.keras.layers.Dense(units=latent_dim)(encoder)
+    # Output layers - no activation for mu and log_var, kept in float32 for the KL term
+    mu = tf.keras.layers.Dense(units=latent_dim, dtype="float32")(encoder)
+    log_var = tf.keras.layers.Dense(units=latent_dim, dtype="float32")(encoder)
 
     # Clip log_var to prevent numerical instability
     log_var = tf.clip_by_value(log_var, -10, 10)
@@ -96,8 +100,8 @@ def decoder_layers(inputs, dims, activation):
         dec = tf.keras.layers.Dense(units=dim, activation=activation)(dec)
         dec = tf.keras.layers.Dropout(0.2)(dec)
 
-    # Output layer - no activation for continuous values
-    dec = tf.keras.layers.Dense(units=dims[-1])(dec)
+    # Output layer - no activation for continuous values, float32 for the reconstruction loss
+    dec = tf.keras.layers.Dense(units=dims[-1], dtype="float32")(dec)
 
     return dec
 
@@ -113,7 +117,8 @@ def decoder_model(input_shape, dims, activation="relu"):
 
 def vae(encoder, decoder, bert, input_shape, beta=1.0):
     """
-    Create VAE model with improved numerical stability
+    Create VAE model with improved numerical stability, whose outputs are
+    the reconstruction and the per-sample loss
 
     Args:
         encoder: Encoder model
@@ -132,10 +137,11 @@ def vae(encoder, decoder, bert, input_shape, beta=1.0):
         shape=input_shape, name="token_type_ids", dtype=tf.int32
     )
 
-    # Get BERT embeddings (CLS token)
-    embeddings = bert(
+    # Get BERT embeddings (CLS token), in float32 under mixed precision
+    bert_output = bert(
         input_ids, token_type_ids=token_type_ids, attention_mask=attention_mask
-    )[0][:, 0]
+    )
+    embeddings = tf.cast(bert_output[0][:, 0], tf.float32)
 
     # Encode
     mu, log_var, z = encoder(embeddings)
@@ -143,13 +149,18 @@ def vae(encoder, decoder, bert, input_shape, beta=1.0):
     # Decode
     reconstructed = decoder(z)
 
+    # Per-sample loss with beta parameter, exposed as a second output for scoring
+    per_sample_loss = vae_cost(
+        embeddings, reconstructed, mu, log_var, z, kl_weight=beta, reduce=False
+    )
+
     # Create model
     model = tf.keras.Model(
-        inputs=[input_ids, attention_mask, token_type_ids], outputs=reconstructed
+        inputs=[input_ids, attention_mask, token_type_ids],
+        outputs=[reconstructed, per_sample_loss],
     )
 
-    # Add loss with beta parameter
-    loss = vae_cost(embeddings, reconstructed, mu, log_var, z, kl_weight=beta)
+    loss = tf.reduce_mean(per_sample_loss)
     model.add_loss(loss)
     model._name = "VAE"
 
@@ -163,3 +174,37 @@ def vae(encoder, decoder, bert, input_shape, beta=1.0):
     model.add_metric(kl_loss, name="kl_loss")
 
     return model
+
+
+def vae_from_embeddings(encoder, decoder, input_shape, beta=1.0):
+    """
+    Create VAE head that works on precomputed BERT embeddings, with the same
+    (reconstruction, per-sample loss) outputs as vae
+
+    Args:
+        encoder: Encoder model (shared with the full VAE)
+        decoder: Decoder model (shared with the full VAE)
+        input_shape: Embedding shape
+        beta: Beta parameter for beta-VAE (controls KL weight)
+    """
+    embeddings = tf.keras.layers.Input(shape=input_shape, name="embeddings")
+
+    # Encode
+    mu, log_var, z = encoder(embeddings)
+
+    # Decode
+    reconstructed = decoder(z)
+
+    # Per-sample loss with beta parameter, exposed as a second output for scoring
+    per_sample_loss = vae_cost(
+        embeddings, reconstructed, mu, log_var, z, kl_weight=beta, reduce=False
+    )
+
+    # Create model
+    model = tf.keras.Model(inputs=embeddings, outputs=[reconstructed, per_sample_loss])
+
+    model.add_loss(tf.reduce_mean(per_sample_loss))
+    model._name = "VAEHead"
+
+    return model
+
@@ -54,7 +54,7 @@ def comprehensive_parameter_search(test_sentences, test_intents, ood_sentences,
     
     for sentence in all_sentences:
         inputs = __predict_preprocess__(sentence, tokenizer, max_length)
-        logits = classifier.predict(inputs, verbose=0)[0][0]
+        logits = classifier(inputs, training=False)[0].numpy()[0]
         probs = tf.nn.softmax(logits, axis=0).numpy()
         
         classifier_confidences.append(np.max(probs))
@@ -222,7 +222,7 @@ def quick_ensemble_variants(test_sentences, test_intents, ood_sentences, ood_int
     classifier_confidences = []
     for sentence in all_sentences:
         inputs = __predict_preprocess__(sentence, tokenizer, max_length)
-        logits = classifier.predict(inputs, verbose=0)[0][0]
+        logits = classifier(inputs, training=False)[0].numpy()[0]
         probs = tf.nn.softmax(logits, axis=0).numpy()
         classifier_confidences.append(np.max(probs))
     
@@ -341,7 +341,7 @@ def complete_ood_intent_pipeline(test_sentences, test_intents, ood_sentences, oo
     
     for sentence in all_sentences:
         inputs = __predict_preprocess__(sentence, tokenizer, max_length)
-        logits = classifier.predict(inputs, verbose=0)[0][0]
+        logits = classifier(inputs, training=False)[0].numpy()[0]
         probs = tf.nn.softmax(logits, axis=0).numpy()
         
         predicted_class = np.argmax(probs)
@@ -462,7 +462,7 @@ def optimize_ensemble_threshold(test_sentences, ood_sentences, raw_test_loss, ra
     classifier_confidences = []
     for sentence in all_sentences:
         inputs = __predict_preprocess__(sentence, tokenizer, max_length)
-        logits = classifier.predict(inputs, verbose=0)[0][0]
+        logits = classifier(inputs, training=False)[0].numpy()[0]
         probs = tf.nn.softmax(logits, axis=0).numpy()
         max_confidence = np.max(probs)
         classifier_confidences.append(max_confidence)
@@ -525,7 +525,7 @@ def smart_ensemble_detection(raw_test_loss, raw_ood_loss, test_sentences, ood_se
     
     for sentence in all_sentences:
         inputs = __predict_preprocess__(sentence, tokenizer, max_length)
-        logits = classifier.predict(inputs, verbose=0)[0][0]
+        logits = classifier(inputs, training=False)[0].numpy()[0]
         probs = tf.nn.softmax(logits, axis=0).numpy()
         max_prob = np.max(probs)
         classifier_confidences.append(max_prob)
@@ -654,7 +654,7 @@ def complete_evaluation_with_multiclass(test_losses, ood_losses, test_sentences,
         if loss <= best_threshold:
             # In-domain: use classifier
             inputs = __predict_preprocess__(sentence, tokenizer, max_length)
-            logits = classifier.predict(inputs, verbose=0)[0]
+            logits = classifier(inputs, training=False)[0].numpy()
             predicted_class = np.argmax(logits)
             y_pred_multiclass.append(predicted_class)
         else:
@@ -751,7 +751,7 @@ def emergency_fix_evaluation(test_losses, ood_losses, test_sentences, ood_senten
     
     for sentence in test_sentences + ood_sentences:
         inputs = __predict_preprocess__(sentence, tokenizer, max_length)
-        logits = classifier.predict(inputs, verbose=0)[0]
+        logits = classifier(inputs, training=False)[0].numpy()
         max_prob = np.max(tf.nn.softmax(logits, axis=1).numpy())
         
         # Simple ensemble: high loss OR low confidence = OOD
@@ -798,8 +798,8 @@ def check_vae_training_quality(model, train_tf, test_tf):
     train_sample = next(iter(train_tf))
     test_sample = next(iter(test_tf))
     
-    train_recon = model(train_sample, training=False)
-    test_recon = model(test_sample, training=False)
+    train_recon, _ = model(train_sample, training=False)
+    test_recon, _ = model(test_sample, training=False)
     
     print(f"Train reconstruction range: [{np.min(train_recon):.4f}, {np.max(train_recon):.4f}]")
     print(f"Test reconstruction range: [{np.min(test_recon):.4f}, {np.max(test_recon):.4f}]")
@@ -921,7 +921,7 @@ def comprehensive_evaluation(test_losses, ood_losses, test_sentences, ood_senten
     all_logits = []
     for sentence in all_sentences:
         inputs = __predict_preprocess__(sentence, tokenizer, max_length)
-        logits = classifier.predict(inputs)[0]
+        logits = classifier(inputs, training=False)[0].numpy()
         all_logits.append(logits[0])
     
     all_logits = np.array(all_logits)
@@ -1011,7 +1011,7 @@ def ensemble_predict_adaptive(
     for loss, sen in zip(losses, sentences):
         # Get classifier output
         inputs = __predict_preprocess__(sen, tokenizer, max_length)
-        logits = classifier.predict(inputs)[0]
+        logits = classifier(inputs, training=False)[0].numpy()
         probs = tf.nn.softmax(logits, axis=1).numpy()[0]
 
         # Get maximum probability and predicted class
@@ -1072,7 +1072,7 @@ def ensemble_predict(
     for loss, sen in zip(losses, sentences):
         # Get classifier output
         inputs = __predict_preprocess__(sen, tokenizer, max_length)
-        logits = classifier.predict(inputs)[0]
+        logits = classifier(inputs, training=False)[0].numpy()
         probs = tf.nn.softmax(logits, axis=1).numpy()[0]
 
         # Get maximum probability and predicted class
@@ -1129,7 +1129,7 @@ def fit_evt_models(
     for i, (loss, sen, cls) in enumerate(zip(losses, sentences, true_classes)):
         # Get classifier output
         inputs = __predict_preprocess__(sen, tokenizer, max_length)
-        logits = classifier.predict(inputs)[0]
+        logits = classifier(inputs, training=False)[0].numpy()
         probs = tf.nn.softmax(logits, axis=1).numpy()[0]
 
         # Get maximum probability
@@ -1177,7 +1177,7 @@ def fit_evt_models_robust(
             
         # Get classifier output
         inputs = __predict_preprocess__(sen, tokenizer, max_length)
-        logits = classifier.predict(inputs)[0]
+        logits = classifier(inputs, training=False)[0].numpy()
         probs = tf.nn.softmax(logits, axis=1).numpy()[0]
         
         # Get maximum probability
@@ -1269,7 +1269,7 @@ def find_optimal_alpha(
         # Calculate scores for in-domain validation data
         for loss, sen in zip(dev_losses, dev_sentences):
             inputs = __predict_preprocess__(sen, tokenizer, max_length)
-            logits = classifier.predict(inputs)[0]
+            logits = classifier(inputs, training=False)[0].numpy()
             probs = tf.nn.softmax(logits, axis=1).numpy()[0]
             max_prob = np.max(probs)
             ood_score = alpha * (1 - max_prob) + (1 - alpha) * loss
@@ -1278,7 +1278,7 @@ def find_optimal_alpha(
         # Calculate scores for OOD validation data
         for loss, sen in zip(ood_losses, ood_sentences):
             inputs = __predict_preprocess__(sen, tokenizer, max_length)
-            logits = classifier.predict(inputs)[0]
+            logits = classifier(inputs, training=False)[0].numpy()
             probs = tf.nn.softmax(logits, axis=1).numpy()[0]
             max_prob = np.max(probs)
             ood_score = alpha * (1 - max_prob) + (1 - alpha) * loss
@@ -1325,9 +1325,10 @@ def predict(
         if loss <= threshold:
             labels.append(
                 np.argmax(
-                    classifier.predict(
-                        __predict_preprocess__(sen, tokenizer, max_length)
-                    )[0],
+                    classifier(
+                        __predict_preprocess__(sen, tokenizer, max_length),
+                        training=False,
+                    )[0].numpy(),
                     axis=1,
                 )[0]
             )
@@ -1365,12 +1366,17 @@ def run_improved_prediction(config):
 
     print("------------------------------------------------------------------")
 
-    max_length = max_sentence_length(train_sentences, policy=config["seq_length"])
-
     print("Downloading {}".format(config["bert"]))
-    bert, tokenizer = get_bert(config["bert"])
+    hf_cache_dir = os.path.expanduser(
+        config.get("hf_cache_dir", "~/.cache/ensemble_evt/hf")
+    )
+    bert, tokenizer = get_bert(config["bert"], cache_dir=hf_cache_dir)
     print("Download finished successfully!")
 
+    max_length = max_sentence_length(
+        train_sentences, policy=config["seq_length"], tokenizer=tokenizer
+    )
+
     print("------------------------------------------------------------------")
 
     print("Preparing data for bert, it may take a few minutes...")
@@ -1422,26 +1428,30 @@ def run_improved_prediction(config):
         first_layers_to_freeze=11,
         num_epochs=config["finetune_epochs"],
         model_name=config["bert"],
+        bert=bert,
+        cache_dir=hf_cache_dir,
     )
-    classifier.load_weights(os.path.join("artifacts", config["dataset"], "bert/best_model"))
-    bert.layers[0].set_weights(classifier.layers[0].get_weights())
     print("------------------------------------------------------------------")
 
     print("VAE model creation is in progress...")
+    encoder = encoder_model(
+        (config["vector_dim"],),
+        config["latent_dim"],
+        dims=config["encoder"],
+        activation=config["activation"],
+    )
+    decoder = decoder_model(
+        (config["latent_dim"],),
+        dims=config["decoder"],
+        activation=config["activation"],
+    )
+    vae_beta = config.get("vae_beta", 1.0)
     model = vae(
         bert=bert,
-        encoder=encoder_model(
-            (config["vector_dim"],),
-            config["latent_dim"],
-            dims=config["encoder"],
-            activation=config["activation"],
-        ),
-        decoder=decoder_model(
-            (config["latent_dim"],),
-            dims=config["decoder"],
-            activation=config["activation"],
-        ),
+        encoder=encoder,
+        decoder=decoder,
         input_shape=((max_length,)),
+        beta=vae_beta,
     )
 
     model.layers[3].trainable = False
@@ -1449,10 +1459,14 @@ def run_improved_prediction(config):
     # train_loss_metric = tf.keras.metrics.Mean()
     # val_loss_metric = tf.keras.metrics.Mean()
 
-    model.load_weights(os.path.join("artifacts", config["dataset"], "vae", "vae.h5"))
+    # vae_ckpt holds the encoder/decoder only, BERT comes from the fine-tuned classifier
+    head = vae_from_embeddings(encoder, decoder, (config["vector_dim"],), beta=vae_beta)
+    head.load_weights(
+        os.path.join("artifacts", config["dataset"], "vae", "vae_ckpt")
+    ).assert_existing_objects_matched()
     print(
         "Model was created successfully and weights were loaded from {}.".format(
-            os.path.join("artifacts", config["dataset"], "vae", "vae.h5")
+            os.path.join("artifacts", config["dataset"], "vae", "vae_ckpt")
         )
     )
 
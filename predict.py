@@ -4,8 +4,10 @@ import pickle
 
 import numpy as np
 import tensorflow as tf
+import matplotlib.pyplot as plt
 
 from scipy import stats
+from scipy.special import gamma
 from sklearn import metrics
 from sklearn.metrics import roc_auc_score
 
@@ -16,52 +18,95 @@ from data_modules.dataloader import DataLoader
 from model.vae import *
 from model.encoder import *
 from model.model_utils import *
-
-# from model.train import compute_loss_safe
+from model.train import compute_loss_stable
 
 from utils import *
 
 
-def compute_loss_safe(model, data):
+def __sorted_quantile__(sorted_values, q):
     """
-    Compute loss with NaN/Inf checking and handling
+    np.quantile with the default linear method, for an already sorted array
     """
-    losses = []
-    skipped_count = 0
-
-    for step, (x, y, z) in enumerate(data):
-        try:
-            # Compute loss
-            logits = model([x, y, z], training=False)
-            loss_value = model.losses
+    position = np.asarray(q, dtype=np.float64) * (len(sorted_values) - 1)
+    lower = np.floor(position).astype(np.int64)
+    upper = np.minimum(lower + 1, len(sorted_values) - 1)
+    return sorted_values[lower] + (position - lower) * (
+        sorted_values[upper] - sorted_values[lower]
+    )
 
-            if isinstance(loss_value, list):
-                loss_value = loss_value[0]
 
-            loss_numpy = loss_value.numpy()
+def __gev_lmoments__(values, starts):
+    """
+    Fit GEV distributions to several samples at once with Hosking's L-moment estimator
 
-            # Check for NaN or Inf
-            if np.isnan(loss_numpy) or np.isinf(loss_numpy):
-                print(f"Warning: NaN/Inf loss detected at step {step}, skipping")
-                skipped_count += 1
-                continue
+    Args:
+        values: Samples laid out as contiguous segments, each sorted ascending
+        starts: Start index of every segment in values
 
-            losses.append(loss_numpy)
+    Returns:
+        shapes, locs, scales arrays, one entry per segment, in scipy's genextreme
+        convention. Segments with fewer than 3 values get NaN.
+    """
+    values = np.asarray(values, dtype=np.float64)
+    starts = np.asarray(starts, dtype=np.int64)
+    if len(starts) == 0:
+        return np.array([]), np.array([]), np.array([])
+    counts = np.diff(np.r_[starts, len(values)])
+    # Rank of every value inside its own segment
+    ranks = np.arange(len(values)) - np.repeat(starts, counts)
+    n = np.repeat(counts, counts).astype(np.float64)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        # Probability weighted moments of each segment
+        b0 = np.add.reduceat(values, starts) / counts
+        b1 = np.add.reduceat(ranks / (n - 1) * values, starts) / counts
+        b2 = (
+            np.add.reduceat(
+                ranks * (ranks - 1) / ((n - 1) * (n - 2)) * values, starts
+            )
+            / counts
+        )
 
-        except Exception as e:
-            print(f"Error computing loss at step {step}: {e}")
-            skipped_count += 1
-            continue
+        l1 = b0
+        l2 = 2 * b1 - b0
+        z = (2 * b1 - b0) / (3 * b2 - b0) - np.log(2) / np.log(3)
+        shapes = 7.8590 * z + 2.9554 * z**2
+
+        # The general scale/location formulas are 0/0 at shape 0, use the Gumbel limit there
+        gumbel = np.abs(shapes) < 1e-6
+        safe_shapes = np.where(gumbel, 1.0, shapes)
+        scales = np.where(
+            gumbel,
+            l2 / np.log(2),
+            l2 * safe_shapes / ((1 - 2 ** (-safe_shapes)) * gamma(1 + safe_shapes)),
+        )
+        locs = np.where(
+            gumbel,
+            l1 - np.euler_gamma * scales,
+            l1 - scales * (1 - gamma(1 + safe_shapes)) / safe_shapes,
+        )
 
-    if len(losses) == 0:
-        print("ERROR: All losses were invalid!")
-        # Return a default high loss value instead of empty array
-        return np.array([10.0])  # High loss indicates anomaly
+    too_small = counts < 3
+    shapes[too_small] = locs[too_small] = scales[too_small] = np.nan
+    return shapes, locs, scales
 
-    if skipped_count > 0:
-        print(f"Skipped {skipped_count} samples due to invalid losses")
 
-    return np.array(losses)
+def __ood_scores__(classifier, tokenizer, losses, sentences, max_length, alpha=0.5):
+    """
+    Ensemble OOD scores alpha * (1 - max softmax probability) + (1 - alpha) * loss
+    for all sentences, with a mask of the finite ones
+    """
+    # Classifier outputs for all sentences in one batched pass
+    logits = __predict_logits__(classifier, tokenizer, sentences, max_length)
+    # Stable softmax in NumPy: after shifting by the row max, the top term is exp(0) = 1
+    exp_logits = np.exp(logits - logits.max(axis=1, keepdims=True))
+    max_probs = 1.0 / exp_logits.sum(axis=1)
+
+    scores = alpha * (1.0 - max_probs) + (1.0 - alpha) * np.asarray(
+        losses, dtype=np.float32
+    )
+    # NaN/Inf in either the loss or the probability carries over into the score
+    return scores, np.isfinite(scores)
 
 
 def fit_evt_models(
@@ -82,39 +127,36 @@ def fit_evt_models(
     Returns:
         Dictionary mapping class IDs to thresholds
     """
-    # Group validation samples by class
-    class_to_samples = {}
-
-    for i, (loss, sen, cls) in enumerate(zip(losses, sentences, true_classes)):
-        # Get classifier output
-        inputs = __predict_preprocess__(sen, tokenizer, max_length)
-        logits = classifier.predict(inputs)[0]
-        probs = tf.nn.softmax(logits, axis=1).numpy()[0]
-
-        # Get maximum probability
-        max_prob = np.max(probs)
-
-        # Calculate ensemble score with alpha=0.5 (will optimize later)
-        ood_score = 0.5 * (1 - max_prob) + 0.5 * loss
-
-        if cls not in class_to_samples:
-            class_to_samples[cls] = []
-
-        class_to_samples[cls].append(ood_score)
-
-    # Fit EVT models for each class
-    evt_models = {}
-    thresholds = {}
-
-    for cls, scores in class_to_samples.items():
-        # Fit GEV distribution
-        scores_array = np.array(scores)
-        shape, loc, scale = stats.genextreme.fit(-scores_array)
-        evt_models[cls] = (shape, loc, scale)
-
-        # Calculate threshold based on desired FPR
-        threshold = -stats.genextreme.ppf(1 - fpr, shape, loc, scale)
-        thresholds[cls] = threshold
+    # Ensemble scores with alpha=0.5 (will optimize later), invalid ones dropped
+    scores, valid = __ood_scores__(
+        classifier, tokenizer, losses, sentences, max_length
+    )
+    scores = scores[valid]
+    true_classes = np.asarray(true_classes)[valid]
+
+    # Group validation samples by class, each class sorted ascending on -score
+    order = np.lexsort((-scores, true_classes))
+    classes, starts = np.unique(true_classes[order], return_index=True)
+
+    # Fit GEV distributions for all classes at once
+    shapes, locs, scales = __gev_lmoments__(-scores[order], starts)
+    # Calculate thresholds based on desired FPR
+    class_thresholds = -stats.genextreme.ppf(1 - fpr, shapes, locs, scales)
+
+    classes = classes.tolist()
+    ends = np.r_[starts[1:], len(order)]
+    sorted_scores = scores[order]
+    for i in np.flatnonzero(~np.isfinite(class_thresholds)):
+        # Too few or identical samples leave the fit undefined, fall back like the robust variant
+        print(
+            f"Warning: Unreasonable EVT parameters for class {classes[i]}, using percentile"
+        )
+        # Segments are descending in score, reverse to ascending for the quantile
+        class_thresholds[i] = __sorted_quantile__(
+            sorted_scores[starts[i] : ends[i]][::-1], 1 - fpr
+        )
+    evt_models = dict(zip(classes, zip(shapes, locs, scales)))
+    thresholds = dict(zip(classes, class_thresholds))
 
     return thresholds, evt_models
 
@@ -132,95 +174,88 @@ def fit_evt_models_robust(
     """
     Fit EVT models with outlier detection and robustness improvements
     """
-    # Group validation samples by class
-    class_to_samples = {}
-
-    for i, (loss, sen, cls) in enumerate(zip(losses, sentences, true_classes)):
-        # Skip invalid losses
-        if np.isnan(loss) or np.isinf(loss):
-            continue
-
-        # Get classifier output
-        inputs = __predict_preprocess__(sen, tokenizer, max_length)
-        logits = classifier.predict(inputs)[0]
-        probs = tf.nn.softmax(logits, axis=1).numpy()[0]
-
-        # Get maximum probability
-        max_prob = np.max(probs)
-
-        # Calculate ensemble score with alpha=0.5
-        ood_score = 0.5 * (1 - max_prob) + 0.5 * loss
-
-        # Skip invalid scores
-        if np.isnan(ood_score) or np.isinf(ood_score):
-            continue
-
-        if cls not in class_to_samples:
-            class_to_samples[cls] = []
+    # Ensemble scores with alpha=0.5, skipping invalid losses and scores
+    scores, valid = __ood_scores__(
+        classifier, tokenizer, losses, sentences, max_length
+    )
+    scores = scores[valid]
+    true_classes = np.asarray(true_classes)[valid]
 
-        class_to_samples[cls].append(ood_score)
+    # Sort once by class then score, each class is a contiguous ascending segment
+    order = np.lexsort((scores, true_classes))
+    sorted_scores = scores[order]
+    sorted_classes = true_classes[order]
+    classes, starts = np.unique(sorted_classes, return_index=True)
+    ends = np.r_[starts[1:], len(sorted_classes)]
 
     # Fit EVT models for each class with outlier removal
     evt_models = {}
     thresholds = {}
+    # Classes with a usable fit, thresholded together after the loop
+    fitted = []
 
-    for cls, scores in class_to_samples.items():
-        if len(scores) < 10:  # Need minimum samples
+    for cls, start, end in zip(classes.tolist(), starts, ends):
+        scores_array = sorted_scores[start:end]
+        if len(scores_array) < 10:  # Need minimum samples
             print(
-                f"Warning: Class {cls} has only {len(scores)} samples, using percentile threshold"
+                f"Warning: Class {cls} has only {len(scores_array)} samples, using percentile threshold"
             )
-            thresholds[cls] = np.percentile(scores, 95)
+            thresholds[cls] = __sorted_quantile__(scores_array, 0.95)
             continue
 
-        scores_array = np.array(scores)
-
         # Remove outliers using IQR method
-        q1 = np.percentile(scores_array, 25)
-        q3 = np.percentile(scores_array, 75)
+        q1, q3 = __sorted_quantile__(scores_array, [0.25, 0.75])
         iqr = q3 - q1
         lower_bound = q1 - 1.5 * iqr
         upper_bound = q3 + 1.5 * iqr
 
-        # Keep only scores within bounds
-        scores_clean = scores_array[
-            (scores_array >= lower_bound) & (scores_array <= upper_bound)
-        ]
+        # Keep only scores within bounds, a contiguous and still sorted slice
+        first = np.searchsorted(scores_array, lower_bound, side="left")
+        last = np.searchsorted(scores_array, upper_bound, side="right")
+        scores_clean = scores_array[first:last]
 
         if len(scores_clean) < 5:
             print(f"Warning: Too few samples after outlier removal for class {cls}")
-            thresholds[cls] = np.percentile(scores_array, 95)
+            thresholds[cls] = __sorted_quantile__(scores_array, 0.95)
             continue
 
         try:
-            # Fit GEV distribution on clean data
-            shape, loc, scale = stats.genextreme.fit(-scores_clean)
+            # Fit GEV distribution on clean data, reversed so -scores is ascending
+            (shape,), (loc,), (scale,) = __gev_lmoments__(-scores_clean[::-1], [0])
 
             # Check if parameters are reasonable
-            if abs(shape) > 2 or scale <= 0 or scale > 10:
+            if (
+                not np.isfinite([shape, loc, scale]).all()
+                or abs(shape) > 2
+                or scale <= 0
+                or scale > 10
+            ):
                 print(
                     f"Warning: Unreasonable EVT parameters for class {cls}, using percentile"
                 )
-                thresholds[cls] = np.percentile(scores_clean, 100 * (1 - fpr))
+                thresholds[cls] = __sorted_quantile__(scores_clean, 1 - fpr)
             else:
                 evt_models[cls] = (shape, loc, scale)
-                # Calculate threshold based on desired FPR
-                threshold = -stats.genextreme.ppf(1 - fpr, shape, loc, scale)
-
-                # Sanity check threshold
-                if (
-                    threshold < np.min(scores_clean)
-                    or threshold > np.max(scores_array) * 2
-                ):
-                    print(
-                        f"Warning: EVT threshold out of range for class {cls}, using percentile"
-                    )
-                    threshold = np.percentile(scores_clean, 100 * (1 - fpr))
-
-                thresholds[cls] = threshold
+                fitted.append((cls, scores_clean, scores_array[-1]))
 
         except Exception as e:
             print(f"Error fitting EVT for class {cls}: {e}, using percentile")
-            thresholds[cls] = np.percentile(scores_clean, 100 * (1 - fpr))
+            thresholds[cls] = __sorted_quantile__(scores_clean, 1 - fpr)
+
+    if fitted:
+        # Calculate thresholds of all fitted classes based on desired FPR in one call
+        shapes, locs, scales = np.array([evt_models[cls] for cls, _, _ in fitted]).T
+        evt_thresholds = -stats.genextreme.ppf(1 - fpr, shapes, locs, scales)
+
+        for (cls, scores_clean, max_score), threshold in zip(fitted, evt_thresholds):
+            # Sanity check threshold
+            if threshold < scores_clean[0] or threshold > max_score * 2:
+                print(
+                    f"Warning: EVT threshold out of range for class {cls}, using percentile"
+                )
+                threshold = __sorted_quantile__(scores_clean, 1 - fpr)
+
+            thresholds[cls] = threshold
 
     return thresholds, evt_models
 
@@ -228,12 +263,52 @@ def fit_evt_models_robust(
 def __predict_preprocess__(x, tokenizer, max_length):
     x_tokenized = tokenizer(
         x,
-        return_tensors="tf",
+        return_tensors="np",
         padding="max_length",
         max_length=max_length,
         truncation=True,
     )
-    return {i: x_tokenized[i] for i in tokenizer.model_input_names}
+    return {
+        i: x_tokenized[i].astype(np.int32, copy=False)
+        for i in tokenizer.model_input_names
+    }
+
+
+def __inference_fn__(classifier, tokenizer, max_length):
+    """
+    Wrap the classifier into an inference-only graph with a fixed input signature,
+    returning float32 logits
+    """
+    input_signature = [
+        {
+            name: tf.TensorSpec((None, max_length), tf.int32, name=name)
+            for name in tokenizer.model_input_names
+        }
+    ]
+
+    @tf.function(input_signature=input_signature)
+    def inference(inputs):
+        return tf.cast(classifier(inputs, training=False)[0], tf.float32)
+
+    return inference
+
+
+def __predict_logits__(classifier, tokenizer, sentences, max_length, batch_size=64):
+    """
+    Tokenize all sentences at once and run the classifier over them in batches
+
+    classifier is either the Keras classifier or a graph from __inference_fn__,
+    passing the latter avoids tracing it again
+    """
+    if isinstance(classifier, tf.keras.Model):
+        classifier = __inference_fn__(classifier, tokenizer, max_length)
+    inputs = __predict_preprocess__(list(sentences), tokenizer, max_length)
+    dataset = (
+        tf.data.Dataset.from_tensor_slices(inputs)
+        .batch(batch_size)
+        .prefetch(tf.data.AUTOTUNE)
+    )
+    return np.concatenate([classifier(batch).numpy() for batch in dataset], axis=0)
 
 
 def predict(
@@ -245,23 +320,23 @@ def predict(
     ood_label: int,
     max_length: int,
 ) -> list:
-    labels = []
-    for loss, sen in zip(losses, sentences):
-        if loss <= threshold:
-            labels.append(
-                np.argmax(
-                    classifier.predict(
-                        __predict_preprocess__(sen, tokenizer, max_length)
-                    )[0],
-                    axis=1,
-                )[0]
-            )
-        else:
-            labels.append(ood_label)
-    return labels
+    labels = np.full(len(sentences), ood_label, dtype=np.int32)
+    # Only sentences under the threshold need the classifier, the rest are OOD
+    in_idx = np.flatnonzero(np.asarray(losses) <= threshold)
+    if in_idx.size:
+        logits = __predict_logits__(
+            classifier, tokenizer, [sentences[i] for i in in_idx], max_length
+        )
+        labels[in_idx] = np.argmax(logits, axis=1)
+    return labels.tolist()
 
 
 def run(config):
+    # Inference only, so reduced precision needs no loss scaling here
+    tf.keras.mixed_precision.set_global_policy(
+        config.get("mixed_precision_policy", "float32")
+    )
+
     print("Loading data from {}...".format(os.path.join("data", config["dataset"])))
     dataloader = DataLoader(path=os.path.join("dataset", config["dataset"]))
     train_sentences, train_intents = dataloader.train_loader()
@@ -290,41 +365,64 @@ def run(config):
 
     print("------------------------------------------------------------------")
 
-    max_length = max_sentence_length(train_sentences, policy=config["seq_length"])
-
     print("Downloading {}".format(config["bert"]))
-    bert, tokenizer = get_bert(config["bert"])
+    hf_cache_dir = os.path.expanduser(
+        config.get("hf_cache_dir", "~/.cache/ensemble_evt/hf")
+    )
+    bert, tokenizer = get_bert(config["bert"], cache_dir=hf_cache_dir)
     print("Download finished successfully!")
 
+    max_length = max_sentence_length(
+        train_sentences, policy=config["seq_length"], tokenizer=tokenizer
+    )
+
     print("------------------------------------------------------------------")
 
     print("Preparing data for bert, it may take a few minutes...")
-    train_input_ids, train_attention_mask, train_token_type_ids = preprocessing(
-        tokenizer, train_sentences, max_length
+    # Token ids only depend on the tokenizer, split and max_length, reuse them across runs
+    tok_cache_dir = os.path.join("artifacts", config["dataset"], "tok_cache")
+    train_input_ids, train_attention_mask, train_token_type_ids = cached_preprocessing(
+        tokenizer, train_sentences, max_length, tok_cache_dir, "train"
     )
-    test_input_ids, test_attention_mask, test_token_type_ids = preprocessing(
-        tokenizer, test_sentences, max_length
+    test_input_ids, test_attention_mask, test_token_type_ids = cached_preprocessing(
+        tokenizer, test_sentences, max_length, tok_cache_dir, "test"
     )
-    dev_input_ids, dev_attention_mask, dev_token_type_ids = preprocessing(
-        tokenizer, dev_sentences, max_length
+    dev_input_ids, dev_attention_mask, dev_token_type_ids = cached_preprocessing(
+        tokenizer, dev_sentences, max_length, tok_cache_dir, "dev"
     )
-    ood_input_ids, ood_attention_mask, ood_token_type_ids = preprocessing(
-        tokenizer, ood_sentences, max_length
+    ood_input_ids, ood_attention_mask, ood_token_type_ids = cached_preprocessing(
+        tokenizer, ood_sentences, max_length, tok_cache_dir, "ood"
     )
 
-    # train_tf = to_tf_format((train_input_ids, train_attention_mask, train_token_type_ids), None, len(train_sentences), batch_size=1)
+    # Losses are matched to sentences by position, so keep the original order
+    eval_batch_size = config.get("eval_batch_size", 64)
+    train_tf = to_tf_format(
+        (train_input_ids, train_attention_mask, train_token_type_ids),
+        None,
+        len(train_sentences),
+        batch_size=eval_batch_size,
+        shuffle=False,
+    )
+    dev_tf = to_tf_format(
+        (dev_input_ids, dev_attention_mask, dev_token_type_ids),
+        None,
+        len(dev_sentences),
+        batch_size=eval_batch_size,
+        shuffle=False,
+    )
     test_tf = to_tf_format(
         (test_input_ids, test_attention_mask, test_token_type_ids),
         None,
         len(test_sentences),
-        batch_size=1,
+        batch_size=eval_batch_size,
+        shuffle=False,
     )
-    # dev_tf = to_tf_format((dev_input_ids, dev_attention_mask, dev_token_type_ids), None, len(dev_sentences), batch_size=1)
     ood_tf = to_tf_format(
         (ood_input_ids, ood_attention_mask, ood_token_type_ids),
         None,
         len(ood_sentences),
-        batch_size=1,
+        batch_size=eval_batch_size,
+        shuffle=False,
     )
     print("Data preparation finished successfully!")
 
@@ -347,28 +445,33 @@ def run(config):
         first_layers_to_freeze=11,
         num_epochs=config["finetune_epochs"],
         model_name=config["bert"],
+        bert=bert,
+        cache_dir=hf_cache_dir,
     )
-    classifier.load_weights(
-        os.path.join("artifacts", config["dataset"], "bert/best_model")
-    )
-    bert.layers[0].set_weights(classifier.layers[0].get_weights())
+    # The classifier is only used for inference from here on, trace it once
+    classifier = __inference_fn__(classifier, tokenizer, max_length)
     print("------------------------------------------------------------------")
 
     print("VAE model creation is in progress...")
+    encoder = encoder_model(
+        (config["vector_dim"],),
+        config["latent_dim"],
+        dims=config["encoder"],
+        activation=config["activation"],
+    )
+    decoder = decoder_model(
+        (config["latent_dim"],),
+        dims=config["decoder"],
+        activation=config["activation"],
+    )
+    # Same beta as in main.py, it is baked into the per-sample loss output
+    vae_beta = config.get("vae_beta", 1.0)
     model = vae(
         bert=bert,
-        encoder=encoder_model(
-            (config["vector_dim"],),
-            config["latent_dim"],
-            dims=config["encoder"],
-            activation=config["activation"],
-        ),
-        decoder=decoder_model(
-            (config["latent_dim"],),
-            dims=config["decoder"],
-            activation=config["activation"],
-        ),
+        encoder=encoder,
+        decoder=decoder,
         input_shape=((max_length,)),
+        beta=vae_beta,
     )
 
     model.layers[3].trainable = False
@@ -376,58 +479,53 @@ def run(config):
     # train_loss_metric = tf.keras.metrics.Mean()
     # val_loss_metric = tf.keras.metrics.Mean()
 
-    model.load_weights(os.path.join("artifacts", config["dataset"], "vae", "vae.h5"))
+    # vae_ckpt holds the encoder/decoder only, BERT comes from the fine-tuned classifier
+    head = vae_from_embeddings(encoder, decoder, (config["vector_dim"],), beta=vae_beta)
+    head.load_weights(
+        os.path.join("artifacts", config["dataset"], "vae", "vae_ckpt")
+    ).assert_existing_objects_matched()
     print(
         "Model was created successfully and weights were loaded from {}.".format(
-            os.path.join("artifacts", config["dataset"], "vae", "vae.h5")
+            os.path.join("artifacts", config["dataset"], "vae", "vae_ckpt")
         )
     )
 
     print("------------------------------------------------------------------")
 
-    # Calculate losses for dev, test, and ood sets
-    train_tf = to_tf_format(
-        (train_input_ids, train_attention_mask, train_token_type_ids),
-        None,
-        len(train_sentences),
-        batch_size=1,
-    )
-    dev_tf = to_tf_format(
-        (dev_input_ids, dev_attention_mask, dev_token_type_ids),
-        None,
-        len(dev_sentences),
-        batch_size=1,
-    )
-    test_tf = to_tf_format(
-        (test_input_ids, test_attention_mask, test_token_type_ids),
-        None,
-        len(test_sentences),
-        batch_size=1,
-    )
-    ood_tf = to_tf_format(
-        (ood_input_ids, ood_attention_mask, ood_token_type_ids),
-        None,
-        len(ood_sentences),
-        batch_size=1,
-    )
-
-    train_loss = compute_loss_safe(model, train_tf)
-    dev_loss = compute_loss_safe(model, dev_tf)
-    test_loss = compute_loss_safe(model, test_tf)
-    ood_loss = compute_loss_safe(model, ood_tf)
+    # Calculate losses for train, dev, test, and ood sets
+    if config.get("quantize_bert", False):
+        # main.py trained the VAE head on int8 TFLite embeddings, score with the same features
+        interpreter = quantize_bert(bert, max_length)
+        train_loss, dev_loss, test_loss, ood_loss = (
+            compute_loss_stable(
+                head,
+                to_tf_format(
+                    quantized_embeddings(interpreter, split_tf),
+                    None,
+                    batch_size=eval_batch_size,
+                    shuffle=False,
+                ),
+            )
+            for split_tf in (train_tf, dev_tf, test_tf, ood_tf)
+        )
+    else:
+        train_loss = compute_loss_stable(model, train_tf)
+        dev_loss = compute_loss_stable(model, dev_tf)
+        test_loss = compute_loss_stable(model, test_tf)
+        ood_loss = compute_loss_stable(model, ood_tf)
 
     # Fix normalization - use proper function
     normalized_train_loss = normalize(
         train_loss, path=os.path.join("artifacts", config["dataset"]), mode="train"
     )
-    normalized_dev_loss = normalize(
-        dev_loss, path=os.path.join("artifacts", config["dataset"]), mode="eval"
-    )
-    normalized_test_loss = normalize(
-        test_loss, path=os.path.join("artifacts", config["dataset"]), mode="eval"
-    )
-    normalized_ood_loss = normalize(
-        ood_loss, path=os.path.join("artifacts", config["dataset"]), mode="eval"
+    # One scaler load and transform for all evaluation splits
+    normalized_dev_loss, normalized_test_loss, normalized_ood_loss = np.split(
+        normalize(
+            np.concatenate([dev_loss, test_loss, ood_loss]),
+            path=os.path.join("artifacts", config["dataset"]),
+            mode="eval",
+        ),
+        np.cumsum([len(dev_loss), len(test_loss)]),
     )
     print(test_loss)
     # Visualize test and OOD losses
@@ -448,6 +546,27 @@ def run(config):
         ),
     )
 
+    # Evaluation data and ground truth shared by both detection approaches
+    eval_losses = np.concatenate([normalized_test_loss, normalized_ood_loss])
+    eval_sentences = test_sentences + ood_sentences
+    y_true_multiclass = np.concatenate(
+        [
+            np.fromiter(
+                (in_lbl_2_indx[i] for i in test_intents),
+                dtype=np.int32,
+                count=len(test_intents),
+            ),
+            np.full(len(ood_sentences), len(in_lbl_2_indx), dtype=np.int32),
+        ]
+    )
+    # For binary classification (in-domain vs OOD)
+    y_true_binary = np.concatenate(
+        [
+            np.zeros(len(test_sentences), dtype=np.int8),
+            np.ones(len(ood_sentences), dtype=np.int8),
+        ]
+    )
+
     # Choose detection approach based on configuration
     if config.get("use_evt_vae", False):
         # EVT-VAE Only approach
@@ -487,11 +606,6 @@ def run(config):
         evt_threshold = evt_results["evt"]["threshold"]
         print(f"Using EVT threshold: {evt_threshold:.4f}")
 
-        # Evaluate on test and OOD data
-        eval_losses = np.concatenate([normalized_test_loss, normalized_ood_loss])
-        # eval_losses = np.concatenate([test_loss, ood_loss])
-        eval_sentences = test_sentences + ood_sentences
-
         # Make predictions using VAE loss threshold
         y_pred_multiclass = predict(
             classifier,
@@ -502,13 +616,9 @@ def run(config):
             len(in_lbl_2_indx),
             max_length,
         )
-        y_true_multiclass = [in_lbl_2_indx[i] for i in test_intents] + [
-            len(in_lbl_2_indx)
-        ] * len(ood_sentences)
 
         # For binary classification (in-domain vs OOD)
-        y_true_binary = [0] * len(test_sentences) + [1] * len(ood_sentences)
-        y_pred_binary = [0 if loss <= evt_threshold else 1 for loss in eval_losses]
+        y_pred_binary = (eval_losses > evt_threshold).astype(np.int8)
 
         # Calculate metrics
         print("----------------------------------")
@@ -562,27 +672,19 @@ def run(config):
             )
         )
 
-        # Combine test and OOD data
-        eval_loss = np.concatenate([normalized_test_loss, normalized_ood_loss])
-        eval_sentences = test_sentences + ood_sentences
-
         # Make predictions using fixed threshold
         y_pred_multiclass = predict(
             classifier,
             tokenizer,
-            eval_loss,
+            eval_losses,
             eval_sentences,
             fixed_threshold,
             len(in_lbl_2_indx),
             max_length,
         )
-        y_true_multiclass = [in_lbl_2_indx[i] for i in test_intents] + [
-            len(in_lbl_2_indx)
-        ] * len(ood_sentences)
 
         # For binary classification (in-domain vs OOD)
-        y_true_binary = [0] * len(test_sentences) + [1] * len(ood_sentences)
-        y_pred_binary = [0 if loss <= fixed_threshold else 1 for loss in eval_loss]
+        y_pred_binary = (eval_losses > fixed_threshold).astype(np.int8)
 
         # Calculate metrics
         print("----------------------------------")
@@ -601,7 +703,7 @@ def run(config):
         )
 
         try:
-            auc_roc = metrics.roc_auc_score(y_true_binary, eval_loss)
+            auc_roc = metrics.roc_auc_score(y_true_binary, eval_losses)
             print(f"AUC-ROC: {auc_roc:.4f}")
         except:
             print("Could not calculate AUC-ROC")
@@ -1,11 +1,14 @@
 import os
 import pickle
+import matplotlib
 import numpy as np
 from scipy import stats
 from sklearn import metrics
-import matplotlib.pyplot as plt
 from sklearn.preprocessing import MinMaxScaler
 
+# Figures are only ever written to disk, so skip GUI backend detection
+matplotlib.use("Agg")
+
 
 def normalize_safe(data, path, mode="train"):
     """
@@ -51,7 +54,11 @@ def normalize_safe(data, path, mode="train"):
 
 
 def visualize(data, path):
-    fig, (ax1, ax2) = plt.subplots(1, 2, figsize=(18, 6))
+    # A standalone Figure avoids pyplot's global state, so this is safe to call from worker threads
+    from matplotlib.figure import Figure
+
+    fig = Figure(figsize=(18, 6))
+    ax1, ax2 = fig.subplots(1, 2)
     _ = ax1.hist(data, bins="auto", cumulative=True)
     _ = ax2.hist(data, bins="auto", cumulative=False)
     fig.savefig(path)
@@ -82,6 +89,8 @@ def create_analysis_visualizations(
     """
     Create comprehensive visualizations to analyze the ensemble approach
     """
+    import matplotlib.pyplot as plt
+
     # Calculate ensemble scores
     test_scores = [
         alpha * (1 - np.max(p)) + (1 - alpha) * l
@@ -174,6 +183,8 @@ def evt_vae_only(
     Returns:
         Dictionary containing performance metrics and thresholds
     """
+    import matplotlib.pyplot as plt
+
     # Sort losses to examine the distribution
     sorted_dev_losses = np.sort(dev_losses)
 
@@ -333,6 +344,8 @@ def visualize_vae_losses(
     test_losses, ood_losses, threshold, path, title="VAE Loss Distribution"
 ):
     """Create visualization of VAE losses for in-domain and OOD data"""
+    import matplotlib.pyplot as plt
+
     plt.figure(figsize=(10, 6))
     plt.hist(
         test_losses, bins=30, alpha=0.7, density=True, label="In-domain", color="blue"